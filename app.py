@@ -1,30 +1,34 @@
 import os
-import uuid
 import datetime
 import random
+import secrets
 import smtplib
-import threading
+
+from concurrent.futures import ThreadPoolExecutor
 
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
 from flask import (
     Flask, render_template, request, redirect,
-    url_for, abort, flash, g
+    url_for, abort, flash
 )
 
 from sqlalchemy import (
     create_engine, Column, Integer, String,
-    DateTime, ForeignKey, Boolean, text
+    DateTime, ForeignKey, Boolean, text, select, delete,
+    Index, or_
 )
 
 from sqlalchemy.orm import (
     sessionmaker, declarative_base,
-    relationship, scoped_session
+    relationship, scoped_session, joinedload
 )
 
 from dotenv import load_dotenv
 
+from celery import Celery
+
 # =========================
 # CONFIG
 # =========================
@@ -40,11 +44,24 @@ GMAIL_PASSWORD = os.getenv("GMAIL_PASSWORD")
 app = Flask(__name__, template_folder="templates")
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "super_secret_key")
 
+celery = Celery(
+    "amigo",
+    broker=os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0")
+)
+
 # =========================
 # DB SETUP
 # =========================
 
-engine = create_engine(DATABASE_URL, echo=False, future=True)
+engine = create_engine(
+    DATABASE_URL,
+    echo=False,
+    future=True,
+    pool_size=10,
+    max_overflow=20,
+    pool_pre_ping=True,
+    pool_recycle=1800
+)
 SessionLocal = scoped_session(sessionmaker(bind=engine))
 Base = declarative_base()
 
@@ -83,14 +100,26 @@ class Participant(Base):
 
 class Assignment(Base):
     __tablename__ = "assignments"
+    __table_args__ = (
+        Index("ix_assignments_token", "token", unique=True),
+        Index("ix_assignments_giver_id", "giver_id"),
+        Index(
+            "ix_assignments_unviewed", "viewed",
+            sqlite_where=text("viewed = 0"),
+            postgresql_where=text("viewed = false")
+        ),
+    )
 
     id = Column(Integer, primary_key=True)
     giver_id = Column(Integer, ForeignKey("participants.id"), nullable=False)
     receiver_id = Column(Integer, ForeignKey("participants.id"), nullable=False)
 
-    token = Column(String, unique=True, nullable=False)
+    token = Column(String, nullable=False)
     first_seen_at = Column(DateTime)
-    viewed = Column(Boolean, default=False)
+    viewed = Column(
+        Boolean, nullable=False,
+        default=False, server_default=text("0")
+    )
 
     giver = relationship(
         "Participant",
@@ -105,43 +134,73 @@ class Assignment(Base):
     )
 
 
-Base.metadata.create_all(engine)
-
 # =========================
 # MIGRACIÓN WISHLIST (SQLite)
 # =========================
 
+_migrated = False
+
+
 def ensure_wishlist_columns():
-    with engine.connect() as conn:
+    global _migrated
+    if _migrated:
+        return
+
+    # Un solo begin(): todos los ALTER + índices comparten transacción
+    # (y un único write-lock en SQLite) en vez de autocommit por sentencia.
+    with engine.begin() as conn:
         cols = conn.execute(
             text("PRAGMA table_info(participants)")
         ).fetchall()
         names = {c[1] for c in cols}
 
-        def add(col):
-            conn.execute(
-                text(f"ALTER TABLE participants ADD COLUMN {col} TEXT")
+        missing = [
+            col for col in [
+                "favorite_color", "shirt_size",
+                "pants_size", "shoe_size",
+                "gift_notes", "wishlist_updated_at"
+            ]
+            if col not in names
+        ]
+        for col in missing:
+            conn.exec_driver_sql(
+                f"ALTER TABLE participants ADD COLUMN {col} TEXT"
             )
 
-        for col in [
-            "favorite_color", "shirt_size",
-            "pants_size", "shoe_size",
-            "gift_notes", "wishlist_updated_at"
-        ]:
-            if col not in names:
-                add(col)
+        # Índices para bases ya creadas antes de declararlos en el modelo
+        conn.execute(text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_assignments_token "
+            "ON assignments (token)"
+        ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_assignments_giver_id "
+            "ON assignments (giver_id)"
+        ))
+
+    _migrated = True
+
+
+def init_db():
+    Base.metadata.create_all(engine)
+    ensure_wishlist_columns()
+
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Crea tablas e índices y aplica la migración de wishlist."""
+    init_db()
+    print("Base de datos inicializada.")
 
 
-ensure_wishlist_columns()
+# En dev se inicializa sola; en producción correr `flask init-db`
+# una vez al deployar, no en cada arranque de worker.
+if os.getenv("FLASK_ENV") == "development":
+    init_db()
 
 # =========================
 # SESSION HANDLING
 # =========================
 
-@app.before_request
-def create_session():
-    g.db = SessionLocal()
-
 @app.teardown_appcontext
 def shutdown_session(exception=None):
     SessionLocal.remove()
@@ -160,44 +219,82 @@ def require_admin():
 
 
 def do_draw(db):
-    participants = db.query(Participant).all()
-    if len(participants) < 2:
+    ids = db.execute(select(Participant.id)).scalars().all()
+    if len(ids) < 2:
         raise ValueError("Se necesitan al menos 2 participantes.")
 
-    ids = [p.id for p in participants]
-    db.query(Assignment).delete()
+    db.execute(text("DELETE FROM assignments"))
 
-    for _ in range(1000):
-        receivers = ids[:]
-        random.shuffle(receivers)
-        if all(g != r for g, r in zip(ids, receivers)):
-            break
-    else:
-        raise RuntimeError("No se pudo generar un sorteo válido")
+    # Sattolo: permutación cíclica aleatoria, sin puntos fijos garantizado.
+    # randrange(i) (no i+1) es lo que impide que alguien se regale a sí mismo.
+    receivers = ids[:]
+    for i in range(len(receivers) - 1, 0, -1):
+        j = random.randrange(i)
+        receivers[i], receivers[j] = receivers[j], receivers[i]
 
-    for g_id, r_id in zip(ids, receivers):
-        db.add(Assignment(
+    rows = [
+        Assignment(
             giver_id=g_id,
             receiver_id=r_id,
-            token=str(uuid.uuid4())
-        ))
-
+            token=secrets.token_urlsafe(16)
+        )
+        for g_id, r_id in zip(ids, receivers)
+    ]
+    db.bulk_save_objects(rows)
     db.commit()
 
 
-def send_email(to_email, subject, html):
-    if not GMAIL_USER or not GMAIL_PASSWORD:
-        return
-
+def build_message(to_email, subject, html):
     msg = MIMEMultipart("alternative")
     msg["From"] = GMAIL_USER
     msg["To"] = to_email
     msg["Subject"] = subject
     msg.attach(MIMEText(html, "html", "utf-8"))
+    return msg
+
+
+# Gmail tolera pocas conexiones simultáneas por cuenta
+MAX_SMTP_WORKERS = 8
 
+
+def _send_chunk(chunk):
+    # Una sesión SMTP propia por thread: smtplib no es thread-safe.
     with smtplib.SMTP_SSL("smtp.gmail.com", 465, timeout=10) as server:
         server.login(GMAIL_USER, GMAIL_PASSWORD)
-        server.sendmail(GMAIL_USER, to_email, msg.as_string())
+        for to_email, subject, html in chunk:
+            try:
+                msg = build_message(to_email, subject, html)
+                server.sendmail(GMAIL_USER, to_email, msg.as_string())
+            except smtplib.SMTPException as ex:
+                print("Error enviando mail a", to_email, ex)
+
+
+def send_bulk(messages):
+    """Envía el lote repartido entre hasta MAX_SMTP_WORKERS threads.
+
+    Cada thread abre una sesión SMTP y la reutiliza para su parte del
+    lote; un destinatario con error no corta el resto.
+    """
+    if not GMAIL_USER or not GMAIL_PASSWORD or not messages:
+        return
+
+    workers = min(MAX_SMTP_WORKERS, len(messages))
+    chunks = [messages[i::workers] for i in range(workers)]
+
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        futures = [ex.submit(_send_chunk, chunk) for chunk in chunks]
+        for f in futures:
+            exc = f.exception()
+            if exc:
+                raise exc
+
+
+@celery.task(bind=True, max_retries=3)
+def send_bulk_task(self, messages):
+    try:
+        send_bulk(messages)
+    except smtplib.SMTPException as e:
+        raise self.retry(exc=e, countdown=30)
 
 # =========================
 # ADMIN
@@ -206,10 +303,21 @@ def send_email(to_email, subject, html):
 @app.route("/admin")
 def admin_panel():
     require_admin()
-    db = g.db
+    db = SessionLocal
     participants = db.query(Participant).all()
-    assignments = db.query(Assignment).all()
-    assign_map = {a.giver_id: a for a in assignments}
+    # Filas livianas (Row) en lugar de objetos Assignment hidratados:
+    # el template solo necesita estas columnas.
+    rows = db.execute(
+        select(
+            Assignment.giver_id,
+            Assignment.token,
+            Assignment.viewed,
+            Assignment.first_seen_at,
+            Participant.name.label("receiver_name")
+        )
+        .join(Participant, Participant.id == Assignment.receiver_id)
+    ).all()
+    assign_map = {r.giver_id: r for r in rows}
     return render_template(
         "admin.html",
         participants=participants,
@@ -226,8 +334,8 @@ def admin_add():
     if not name or not email:
         flash("Nombre y email obligatorios", "error")
     else:
-        g.db.add(Participant(name=name, email=email))
-        g.db.commit()
+        SessionLocal.add(Participant(name=name, email=email))
+        SessionLocal.commit()
         flash("Participante agregado", "success")
     return redirect(url_for("admin_panel", key=ADMIN_KEY))
 
@@ -235,12 +343,18 @@ def admin_add():
 @app.route("/admin/delete/<int:pid>", methods=["POST"])
 def admin_delete(pid):
     require_admin()
-    g.db.query(Assignment).delete()
-    p = g.db.query(Participant).get(pid)
+    # Solo las asignaciones del participante: el resto del sorteo queda
+    SessionLocal.execute(
+        delete(Assignment).where(or_(
+            Assignment.giver_id == pid,
+            Assignment.receiver_id == pid
+        ))
+    )
+    p = SessionLocal.get(Participant, pid)
     if p:
-        g.db.delete(p)
-    g.db.commit()
-    flash("Participante eliminado. Sorteo reiniciado.", "success")
+        SessionLocal.delete(p)
+    SessionLocal.commit()
+    flash("Participante eliminado junto con sus asignaciones.", "success")
     return redirect(url_for("admin_panel", key=ADMIN_KEY))
 
 
@@ -248,63 +362,35 @@ def admin_delete(pid):
 def admin_draw():
     require_admin()
     try:
-        do_draw(g.db)
+        do_draw(SessionLocal)
         flash("Sorteo generado", "success")
     except Exception as e:
         flash(str(e), "error")
     return redirect(url_for("admin_panel", key=ADMIN_KEY))
 
 
-def send_emails_background(emails):
-    for e in emails:
-        try:
-            send_email(
-                e["to"],
-                "🎁 Tu Amigo Invisible",
-                f"""
-                <p>Hola {e['name']},</p>
-                <p>Tu amigo invisible ya fue asignado 🎄</p>
-                <p>
-                  <a href="{e['link']}">
-                    👉 Descubrir acá
-                  </a>
-                </p>
-                """
-            )
-            print("Mail enviado a", e["to"])
-        except Exception as ex:
-            print("Error enviando mail a", e["to"], ex)
-
-
-
 @app.route("/admin/send", methods=["POST"])
 def admin_send():
     require_admin()
 
-    assignments = g.db.query(Assignment).all()
+    assignments = (
+        SessionLocal.query(Assignment)
+        .options(joinedload(Assignment.giver))
+        .all()
+    )
     base = request.url_root.rstrip("/")
 
-    # ✅ CONSTRUIR DATOS PLANOS
-    emails = []
+    messages = []
     for a in assignments:
         giver = a.giver
         if not giver or not giver.email:
             continue
 
         link = base + "/revelar/" + a.token
-        emails.append({
-            "to": giver.email,
-            "name": giver.name,
-            "link": link
-        })
-
-    # ✅ THREAD CON DATOS PLANOS
-    t = threading.Thread(
-        target=send_emails_background,
-        args=(emails,),
-        daemon=True
-    )
-    t.start()
+        html = render_template("email/reveal.html", giver=giver, link=link)
+        messages.append((giver.email, "🎁 Tu Amigo Invisible", html))
+
+    send_bulk_task.delay(messages)
 
     flash("✅ Envío de emails iniciado correctamente.", "success")
     return redirect(url_for("admin_panel", key=ADMIN_KEY))
@@ -318,8 +404,15 @@ def admin_send():
 
 @app.route("/revelar/<token>", methods=["GET", "POST"])
 def reveal(token):
-    db = g.db
-    a = db.query(Assignment).filter_by(token=token).first()
+    db = SessionLocal
+    a = db.execute(
+        select(Assignment)
+        .where(Assignment.token == token)
+        .options(
+            joinedload(Assignment.receiver),
+            joinedload(Assignment.giver)
+        )
+    ).scalar_one_or_none()
     if not a:
         abort(404)
 
@@ -335,13 +428,14 @@ def reveal(token):
         receiver.shoe_size = request.form.get("shoe_size")
         receiver.gift_notes = request.form.get("gift_notes")
         receiver.wishlist_updated_at = datetime.datetime.now()
-        db.commit()
         flash("🎁 Preferencias guardadas", "success")
 
     if not a.viewed:
         a.viewed = True
         a.first_seen_at = datetime.datetime.now()
-        db.commit()
+
+    # Un solo commit para wishlist + viewed: un fsync por request
+    db.commit()
 
     return render_template(
         "reveal.html",